@@ -22,39 +22,69 @@
 # along with pixel2svg.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import multiprocessing
 import sys
 import os.path
-import re
 
 from PIL import Image
 
-import svgwrite
-from svgwrite.extensions import Inkscape
-
 import numpy as np
-from python_tsp.distances import great_circle_distance_matrix
-from python_tsp.heuristics import solve_tsp_simulated_annealing
+from python_tsp.distances import euclidean_distance_matrix
+from python_tsp.heuristics import solve_tsp_two_opt
 
 VERSION = "0.6.0"
 
+# minimum number of rectangles to format the layers in parallel processes
+PARALLEL_RECTANGLES = 10000
+# minimum number of rectangles to optimize the paths of the layers in parallel processes
+PARALLEL_OPTIMIZE = 1000
+# maximum number of rectangles of a layer to optimize the path with the travelling salesman algorithm.
+# its distance matrix grows with the square of the number of rectangles,
+# larger layers are ordered along a Hilbert curve.
+OPTIMIZE_RECTANGLES = 4096
+
 # some constants
 RED = 0
 GREEN = 1
 BLUE = 2
 ALPHA = 3
 
-class BreakEx(Exception): pass
-
-# compare two RGB colors @p a and @p b for similarity.
-# the @p sensitivity parameter configures how sensitive the color comparison is.
-# larger values for @p sensitivity will make the comparison less sensitive.
-def similar_color(a, b, sensitivity):
+# split a pixel packed into a 32 bit integer into a RGBA tuple.
+# the red byte is the least significant byte, the alpha byte the most significant byte.
+def unpack_color(c):
+    return (c & 0xFF, (c >> 8) & 0xFF, (c >> 16) & 0xFF, (c >> 24) & 0xFF)
+
+# split packed pixels into an array with an additional last axis for the RGB values.
+def unpack_rgb(packed):
+    return np.stack((packed & 0xFF, (packed >> 8) & 0xFF, (packed >> 16) & 0xFF), axis=-1).astype(np.int32)
+
+# count the leading entries of @p rgb, an array of uint8 RGB values with shape (N, ..., 3), whose
+# colors are all similar to the int32 RGB value @p ref.
+# two colors are similar if the sum of the squared differences of their RGB values is smaller
+# than @p sensitivity. larger values for @p sensitivity will make the comparison less sensitive.
+# the entries are compared in blocks which double in size, as most runs of similar colors are short.
+def count_similar(rgb, ref, sensitivity):
+    n = 0
+    block = 8
+    while n < len(rgb):
+        # the uint8 values are widened to int32, so the squares do not overflow
+        diff = rgb[n:n+block] - ref
+        similar = ((diff * diff).sum(axis=-1) < sensitivity).reshape(len(diff), -1).all(axis=1)
+        if not similar.all():
+            return n + int(np.argmin(similar))
+        n += len(similar)
+        block *= 2
+    return n
+
+# check if the packed colors @p a and @p b are similar, as count_similar() compares them.
+# a single pair of pixels is compared faster with python integers than with NumPy.
+def similar_packed(a, b, sensitivity):
     if a == b:
-        return True
-    r = (a[RED]   - b[RED])   ** 2
-    g = (a[GREEN] - b[GREEN]) ** 2
-    b = (a[BLUE]  - b[BLUE])  ** 2
-    return r+g+b < sensitivity
+        return sensitivity > 0
+    r = (a & 0xFF) - (b & 0xFF)
+    g = ((a >> 8) & 0xFF) - ((b >> 8) & 0xFF)
+    b = ((a >> 16) & 0xFF) - ((b >> 16) & 0xFF)
+    return r*r + g*g + b*b < sensitivity
 
 # SVG color keywords
 # https://www.w3.org/TR/SVG11/types.html#ColorKeywords
@@ -208,20 +238,259 @@ svgcolors = {
 'yellowgreen': (154, 205, 50),
 }
 
-# find a SVG color name for a RGB tuple @p c.
+# the SVG color keywords as a list of names and a (N, 3) array of RGB values
+svgcolor_names = list(svgcolors.keys())
+svgcolor_values = np.array(list(svgcolors.values()), dtype=np.int32)
+
+# find the nearest SVG color names for an array of packed colors @p palette.
 # based on https://stackoverflow.com/questions/9694165/convert-rgb-color-to-english-color-name-like-green-with-python
-def color_name(c):
-    min_colors = {}
-    for name, col in svgcolors.items():
-        r = (c[RED]   - col[RED])   ** 2
-        g = (c[GREEN] - col[GREEN]) ** 2
-        b = (c[BLUE]  - col[BLUE])  ** 2
-        min_colors[r + g + b] = name
-    return min_colors[min(min_colors.keys())]
-
-# convert a SVG coordinate to a float number
-def svg2float(c):
-    return float(re.sub('[^.\-\d]', '', str(c)))
+# the distances to all color keywords are computed in one array operation for a block of colors.
+def color_names(palette):
+    rgb = unpack_rgb(palette)
+    names = []
+    for i in range(0, len(rgb), 1024):
+        diff = rgb[i:i+1024, np.newaxis, :] - svgcolor_values[np.newaxis, :, :]
+        distance = (diff * diff).sum(axis=2)
+        # if several colors have the same distance, use the last one.
+        # e.g. "cyan" instead of "aqua" and "grey" instead of "gray".
+        nearest = len(svgcolor_names) - 1 - np.argmin(distance[:, ::-1], axis=1)
+        names.extend(svgcolor_names[k] for k in nearest.tolist())
+    return names
+
+# SVG rect element templates with the arguments fill, height, width, x, y and opacity,
+# indexed by whether the rectangle is fully opaque. the attributes are in alphabetical order.
+RECT_TEMPLATES = ('<rect fill="{0}" height="{1}" opacity="{5}" width="{2}" x="{3}" y="{4}"/>',
+                  '<rect fill="{0}" height="{1}" width="{2}" x="{3}" y="{4}"/>')
+
+# SVG opacity value for each alpha value
+OPACITY_STR = [str(alpha/float(255)) for alpha in range(256)]
+
+# format the SVG rect elements for the rectangles @p rects, an array of shape (N, 5)
+# as returned by find_rectangles().
+# @p fill_str maps the packed colors to SVG fill colors.
+# @p posn_str and @p size_str map pixel positions and sizes to SVG user units.
+def format_rectangles(rects, fill_str, posn_str, size_str):
+    alpha = (rects[:, 4] >> 24).tolist()
+    opaque = (rects[:, 4] >> 24 == 255).tolist()
+    elements = []
+    for ((X, Y, w, h, rgba), a, o) in zip(rects.tolist(), alpha, opaque):
+        elements.append(RECT_TEMPLATES[o].format(
+            fill_str[rgba], size_str[h], size_str[w], posn_str[X], posn_str[Y], OPACITY_STR[a]))
+    return elements
+
+# create the SVG text of an inkscape layer called @p name with the rectangles @p rects.
+# the arguments are the same as for format_rectangles().
+# if @p pretty is set, each element is written on a separate, indented line.
+def serialize_layer(name, rects, fill_str, posn_str, size_str, pretty):
+    (indent, newline) = ('  ', '\n') if pretty else ('', '')
+    lines = [indent + '<g inkscape:groupmode="layer" inkscape:label="{0}" sodipodi:insensitive="1">'.format(name) + newline]
+    for rect in format_rectangles(rects, fill_str, posn_str, size_str):
+        lines.append(indent * 2 + rect + newline)
+    lines.append(indent + '</g>' + newline)
+    return ''.join(lines)
+
+# order the rectangles @p rects, as returned by find_rectangles(), along a Hilbert curve
+# through their top left corners. rectangles close to each other on the curve are close
+# to each other in the image, so this is a short path which is fast to find.
+# returns the order of the rectangles as an array of indices.
+def hilbert_order(rects):
+    X = rects[:, 0]
+    Y = rects[:, 1]
+    n = 1 # side length of the square covered by the curve
+    while n <= max(X.max(), Y.max()):
+        n *= 2
+    d = np.zeros(len(rects), dtype=np.int64) # distance along the curve
+    s = n // 2
+    while s > 0:
+        rx = (X & s) > 0
+        ry = (Y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant, so the curve in it starts and ends at the right corners
+        flip = rx & ~ry
+        X = np.where(flip, n - 1 - X, X)
+        Y = np.where(flip, n - 1 - Y, Y)
+        (X, Y) = (np.where(ry, X, Y), np.where(ry, Y, X))
+        s //= 2
+    return np.argsort(d, kind='stable')
+
+# use travelling salesman algorithm to calculate a good path between the rectangles @p rects,
+# as returned by find_rectangles(). the path starts at the first rectangle.
+# layers with more than OPTIMIZE_RECTANGLES rectangles are ordered by hilbert_order() instead,
+# their path starts where the curve starts, at the top left corner of the image, which is not
+# necessarily at the first rectangle.
+# returns the order of the rectangles as a list or array of indices.
+def optimize_path(rects):
+    if len(rects) > OPTIMIZE_RECTANGLES:
+        return hilbert_order(rects)
+    # 1st step: create a list with rectangle coordinates.
+    # the order does not depend on the size of the pixels, so pixel coordinates are used,
+    # which float32 represents exactly. float32 halves the size of the distance matrix.
+    coord = rects[:, 0:2].astype(np.float32)
+    # 2nd step: create a distance matrix from the coordinates
+    distance_matrix = euclidean_distance_matrix(coord)
+    distance_matrix[:, 0] = 0 # set first column to 0, this will not require a closed path
+    # 3rd step: find a good path
+    permutation, distance = solve_tsp_two_opt(distance_matrix)
+    return permutation
+
+# maximum number of colors of quantize_image(), Pillow quantizes to a palette image
+QUANTIZE_COLORS = 256
+
+# parse the number of colors of the --quantize command line option.
+# argparse reports the error of a value which quantize_image() can not use.
+def quantize_colors(value):
+    colors = int(value)
+    if colors < 1 or colors > QUANTIZE_COLORS:
+        raise argparse.ArgumentTypeError("must be between 1 and {0}: {1}".format(QUANTIZE_COLORS, value))
+    return colors
+
+# reduce the RGB values of the visible pixels of the RGBA @p image to at most @p colors colors.
+# the palette is built from the visible pixels only, so the colors of transparent pixels do not
+# take palette entries away from the visible colors.
+# the alpha channel and the transparent pixels are kept unchanged.
+def quantize_image(image, colors):
+    rgba = np.array(image)
+    visible = rgba[:, :, ALPHA] != 0
+    if not visible.any():
+        return image
+    # quantize the visible pixels as an image of a single row
+    strip = Image.fromarray(rgba[visible][np.newaxis, :, RED:ALPHA])
+    strip = strip.quantize(colors=colors, method=Image.Quantize.MEDIANCUT).convert("RGB")
+    rgba[visible, RED:ALPHA] = np.asarray(strip)[0]
+    return Image.fromarray(rgba)
+
+# count the identical pixels of @p packed in a row starting at each pixel, along @p axis
+# (1 for the pixels to the right, 0 for the pixels below). every pixel counts itself.
+def run_lengths(packed, axis):
+    packed = np.moveaxis(packed, axis, -1)
+    n = packed.shape[-1]
+    index = np.arange(n)
+    # index of the last pixel of the run containing each pixel
+    last = np.ones(packed.shape, dtype=bool)
+    last[..., :-1] = packed[..., 1:] != packed[..., :-1]
+    end = np.minimum.accumulate(np.where(last, index, n)[..., ::-1], axis=-1)[..., ::-1]
+    return np.moveaxis(end - index + 1, -1, axis)
+
+# find the rectangles for the visible pixels of @p packed, combining identical pixels.
+# starting at the top left pixel not yet covered, a rectangle is extended to the right
+# over the identical pixels not yet covered, then downwards while the row below is identical.
+# so an area of one color which is a filled rectangle always results in a single rectangle,
+# other areas are split into rectangles as wide as the runs of their top rows.
+# returns an array of shape (N, 5) with the X, Y, width, height and packed color of each rectangle.
+def find_identical_rectangles(packed):
+    (height, width) = packed.shape
+    right = run_lengths(packed, 1)
+    down = run_lengths(packed, 0)
+    # pixels which still need a rectangle
+    todo = (packed >> 24) != 0
+    rects = []
+    for Y in range(height):
+        row = todo[Y]
+        # a rectangle covers each run of identical pixels of the row which are not covered yet.
+        # the rows below a run are not covered either, rectangles started in earlier rows
+        # which reach them would also cover the run.
+        same = np.zeros(width + 1, dtype=bool)
+        same[1:width] = row[1:] & row[:-1] & (packed[Y, 1:] == packed[Y, :-1])
+        starts = np.flatnonzero(row & ~same[:-1])
+        ends = np.flatnonzero(row & ~same[1:])
+        colors = packed[Y, starts].tolist()
+        depths = down[Y, starts].tolist()
+        for (X, w, rgba, depth) in zip(starts.tolist(), (ends - starts + 1).tolist(), colors, depths):
+            h = 1
+            if depth > 1:
+                # the rows below are identical as long as the run starting at X is not shorter
+                narrow = np.flatnonzero(right[Y+1:Y+depth, X] < w)
+                h = 1 + (narrow[0] if len(narrow) else depth - 1)
+                # these pixels will not be processed any more.
+                todo[Y+1:Y+h, X:X+w] = False
+            rects.append((X, Y, w, int(h), rgba))
+
+    return np.array(rects, dtype=np.int64).reshape(-1, 5)
+
+# find the rectangles for the visible pixels of @p packed, combining pixels with a
+# color similar to the top left pixel of a rectangle.
+# @p sensitivity is passed to count_similar().
+# returns an array of shape (N, 5) with the X, Y, width, height and packed color of each rectangle.
+def find_similar_rectangles(packed, sensitivity):
+    (height, width) = packed.shape
+    # the RGB bytes of the pixels, without a copy
+    rgb = packed.view(np.uint8).reshape(height, width, 4)[:, :, RED:ALPHA]
+    # pixels which still need a rectangle
+    todo = (packed >> 24) != 0
+    rects = []
+    Y = 0 # Y coordinate of current pixel
+    while Y < height:
+
+        #print("Processing pixel row {0} of {1}".format(Y + 1, height))
+
+        # similar colors are relative to the first pixel of a run, walk the row.
+        # the row is inspected when it is reached, because combining pixels
+        # removes pixels of the following rows from todo.
+        row = packed[Y].tolist()
+        below = packed[Y+1].tolist() if Y+1 < height else None
+        X = 0 # first X coordinate not covered by a rectangle in this row
+        # Omit transparent pixels
+        for start in np.flatnonzero(todo[Y]).tolist():
+            if start < X:
+                continue
+            X = start
+            rgba = row[X]
+            ref = None
+
+            # find pixels with similar color horizontally.
+            # on busy images the next pixel often differs already, it is checked
+            # on its own before the remaining pixels are compared in blocks.
+            w = 1
+            if X+1 < width and similar_packed(row[X+1], rgba, sensitivity):
+                ref = rgb[Y, X].astype(np.int32)
+                w = 2 + count_similar(rgb[Y, X+2:], ref, sensitivity)
+            # check if the rows of pixels below have a similar color and can be combined
+            h = 1
+            if below is not None and similar_packed(below[X], rgba, sensitivity):
+                if ref is None:
+                    ref = rgb[Y, X].astype(np.int32)
+                h = 1 + count_similar(rgb[Y+1:, X:X+w], ref, sensitivity)
+                # these pixels will not be processed any more.
+                todo[Y+1:Y+h, X:X+w] = False
+            #print("combine: {0},{1} {2},{3}".format(X,Y,w,h))
+
+            rects.append((X, Y, w, h, rgba))
+            X += w
+
+        Y += 1
+
+    return np.array(rects, dtype=np.int64).reshape(-1, 5)
+
+# find the distinct values of the packed colors @p rgba.
+# returns the array of distinct colors in the order they first appear in @p rgba,
+# and for each element of @p rgba the index of its color in that array.
+def color_palette(rgba):
+    (palette, first, inverse) = np.unique(rgba, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return (palette[order], rank[inverse.ravel()])
+
+# find one rectangle for each visible pixel of @p packed.
+# returns the rectangles in the same form as find_rectangles().
+def find_pixel_rectangles(packed):
+    (Y, X) = np.nonzero(packed >> 24)
+    ones = np.ones(len(X), dtype=np.int64)
+    return np.column_stack((X, Y, ones, ones, packed[Y, X])).astype(np.int64)
+
+# find the rectangles covering the visible pixels of @p packed, a 2D array with one
+# packed RGBA integer per pixel.
+# if @p combine is set, pixels with a similar color are combined into larger rectangles,
+# @p sensitivity is passed to count_similar().
+# each combination of options has its own function, so the pixel loops do not test any options.
+# returns an array of shape (N, 5) with the X, Y, width, height and packed color of each rectangle,
+# ordered by row and column.
+def find_rectangles(packed, combine, sensitivity):
+    if not combine:
+        return find_pixel_rectangles(packed)
+    if sensitivity > 0:
+        return find_similar_rectangles(packed, sensitivity)
+    return find_identical_rectangles(packed)
 
 if __name__ == "__main__":
     argument_parser = argparse.ArgumentParser(description="Convert pixel art to SVG")
@@ -259,6 +528,11 @@ if __name__ == "__main__":
                                  default=0,
                                  help="Configure a numeric value to find a similar color. Larger values make the comparison less sensitive.")
 
+    argument_parser.add_argument("--quantize",
+                                 type=quantize_colors,
+                                 default=0,
+                                 help="Reduce the image to at most QUANTIZE colors (1 to 256) before converting it.")
+
     argument_parser.add_argument("--optimize",
                                  action="store_true",
                                  help="Optimize the order of SVG rectangles to minimize the path.")
@@ -267,6 +541,10 @@ if __name__ == "__main__":
                                  action="store_true",
                                  help="Reverse the order of SVG rectangles.")
 
+    argument_parser.add_argument("--pretty",
+                                 action="store_true",
+                                 help="Write each SVG element on a separate, indented line.")
+
     arguments = argument_parser.parse_args()
     unit = arguments.unit
 
@@ -274,7 +552,11 @@ if __name__ == "__main__":
     print("read: {0}".format(arguments.imagefile))
 
     image = Image.open(arguments.imagefile)
-    image = image.convert("RGBA")
+    # convert() copies the image even if it has the requested mode already
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    if arguments.quantize > 0:
+        image = quantize_image(image, arguments.quantize)
 
     # width and height of the image in pixels
     (image_width, image_height) = image.size
@@ -282,13 +564,13 @@ if __name__ == "__main__":
     print("input image size: {0}x{1} px".format(image_width, image_height))
     print("  SVG image size: {0}x{1} {2}".format(image_width * arguments.squaresize, image_height * arguments.squaresize, unit))
 
-    rgb_values = list(image.getdata())
+    # the raw RGBA bytes of the image in one contiguous buffer,
+    # viewed as one little endian 32 bit word per pixel
+    packed = np.frombuffer(image.tobytes(), dtype='<u4').reshape(image_height, image_width)
+    # the decoded image is not needed any more, free its memory before the pixels are processed
+    del image
 
     svg_filename = os.path.splitext(arguments.imagefile)[0] + ".svg"
-    svgdoc = svgwrite.Drawing(filename=svg_filename,
-                              size=(str(image_width * arguments.squaresize)+unit,
-                                    str(image_height * arguments.squaresize)+unit))
-    inkscape = Inkscape(svgdoc)
 
     # If --overlap is given, use a slight overlap to prevent inaccurate SVG rendering
     overlap = arguments.overlap
@@ -298,132 +580,81 @@ if __name__ == "__main__":
         overlap = 0
     print("overlap: {0} {1}".format(overlap, unit))
 
-    # a dictionary of rectangles
-    # key: rgba tuple
-    # value: list of SVG rectangle objects
-    rectangles = {}
-
-    # iterate over all pixels and create SVG rectangles mapped by the pixel's color
-    rectangle_num = 0
-    Y = 0 # Y coordinate of current pixel
-    while Y < image_height:
-
-        #print("Processing pixel row {0} of {1}".format(Y + 1, image_height))
-
-        X = 0 # X coordinate of current pixel
-        while X < image_width:
-
-            rgba_tuple = rgb_values[Y * image_width + X]
-
-            # Omit transparent pixels
-            w = 1 # width of rectangle
-            alpha = rgba_tuple[ALPHA]
-            if alpha > 0:
-                h = 1 # height of rectangle
-
-                # combine pixels?
-                if arguments.combine:
-                    # find pixels with same color horizontally
-                    while X+w < image_width:
-                        px = rgb_values[Y * image_width + X + w]
-                        if not similar_color(px, rgba_tuple, arguments.similar):
-                            break
-                        w += 1
-                    # check if pixels below have the same color and can be combined?
-                    try:
-                        while Y+h < image_height:
-                            # check if the next row of pixels has a similar color
-                            i = 0
-                            while i < w:
-                                px = rgb_values[(Y+h) * image_width + X + i]
-                                if not similar_color(px, rgba_tuple, arguments.similar):
-                                    raise BreakEx
-                                i += 1
-                                # the color is similar.
-                                # set the alpha value of all these pixels to 0, so they will not be processed any more.
-                            i = 0
-                            while i < w:
-                                # the pixel is a python tuple and constant.
-                                # create a new tuple with alpha=0 and assign to the pixel array.
-                                px = rgb_values[(Y+h) * image_width + X + i]
-                                rgb_values[(Y+h) * image_width + X + i] = (px[RED], px[GREEN], px[BLUE], 0)
-                                i += 1
-
-                            h += 1
-
-                    except BreakEx:
-                        pass
-                    #print("combine: {0},{1} {2},{3}".format(X,Y,w,h))
-
-                rectangle_num += 1
-                rectangle_posn = (str(X * arguments.squaresize)+unit,
-                                  str(Y * arguments.squaresize)+unit)
-                rectangle_size = (str(w * arguments.squaresize + overlap)+unit,
-                                  str(h * arguments.squaresize + overlap)+unit)
-                rectangle_fill = svgwrite.rgb(rgba_tuple[0], rgba_tuple[1], rgba_tuple[2])
-                rect = 1
-
-                if alpha == 255:
-                    rect = svgdoc.rect(insert=rectangle_posn,
-                                       size=rectangle_size,
-                                       fill=rectangle_fill)
-                else:
-                    rect = svgdoc.rect(insert=rectangle_posn,
-                                       size=rectangle_size,
-                                       fill=rectangle_fill,
-                                       opacity=alpha/float(255))
-
-                rectangles.setdefault(rgba_tuple, []).append(rect)
-
-            X += w
-
-        Y += 1
-
-    print("used {0} rectangles".format(rectangle_num))
-    print("found {0} colors".format(len(rectangles)))
-
-    # output rectangles on a separate layer for each color
-    layer_num = 0
-    for rgba_tuple in rectangles:
-        name = color_name(rgba_tuple)
-        rectangles_num = len(rectangles[rgba_tuple])
-        print("  "+name+" for "+str(rgba_tuple)+" with "+str(rectangles_num)+" rectangles")
-        layer = inkscape.layer(label=name, locked=True)
-        svgdoc.add(layer)
-
-        # use travelling salesman algorithm to calculate a good path between the rectangles?
-        # the command line option to optimize the rectangle order needs to be enabled,
-        # and there need to be at least 3 rectangles.
-        if arguments.optimize and rectangles_num > 2:
-
-            # 1st step: create a list with rectangle coordinates
-            coord = []
-            for rect in rectangles[rgba_tuple]:
-                coord.append([svg2float(rect.attribs['x']), svg2float(rect.attribs['y'])])
-            # 2nd step: create a distance matrix from the coordinates
-            distance_matrix = great_circle_distance_matrix(np.array(coord))
-            distance_matrix[:, 0] = 0 # set first column to 0, this will not require a closed path
-            # 3rd step: find a good path
-            permutation, distance = solve_tsp_simulated_annealing(distance_matrix)
-            # 4th step: add SVG rectangles to the layer
-            if arguments.reverse:
-                permutation.reverse()
-            for idx in permutation:
-                layer.add(rectangles[rgba_tuple][idx])
+    rects = find_rectangles(packed, arguments.combine, arguments.similar)
+
+    # the colors of all rectangles, and for each rectangle the index of its color
+    (palette, color_index) = color_palette(rects[:, 4])
+
+    # a list with an array of rectangles for each color in the palette.
+    # the rectangles keep their order, the SVG elements are only created when a layer is written.
+    order = np.argsort(color_index, kind='stable')
+    counts = np.bincount(color_index, minlength=len(palette))
+    rectangles = np.split(rects[order], np.cumsum(counts)[:-1])
+
+    # SVG fill color of each color in the palette, and SVG coordinate and size strings for
+    # every possible pixel position and rectangle size, so they are not formatted again for each rectangle.
+    # the viewBox of the SVG element makes one user unit as large as one unit, so the
+    # coordinates and sizes are plain numbers.
+    fill_str = {rgba: "rgb({0},{1},{2})".format(rgba & 0xFF, (rgba >> 8) & 0xFF, (rgba >> 16) & 0xFF)
+                for rgba in palette.tolist()}
+    squaresize = arguments.squaresize
+    posn_str = [str(i * squaresize) for i in range(max(image_width, image_height))]
+    size_str = [str(i * squaresize + overlap) for i in range(max(image_width, image_height) + 1)]
+
+    print("used {0} rectangles".format(len(rects)))
+    print("found {0} colors".format(len(palette)))
+
+    # use travelling salesman algorithm to calculate a good path between the rectangles?
+    # the command line option to optimize the rectangle order needs to be enabled,
+    # and there need to be at least 3 rectangles in a layer.
+    # the paths of the layers are independent of each other and can be optimized in parallel.
+    layer_rects = list(rectangles)
+    if arguments.optimize:
+        optimized = [k for k in range(len(palette)) if len(rectangles[k]) > 2]
+        jobs = [rectangles[k] for k in optimized]
+        if len(jobs) > 1 and sum(len(job) for job in jobs) >= PARALLEL_OPTIMIZE and multiprocessing.cpu_count() > 1:
+            with multiprocessing.Pool() as pool:
+                permutations = pool.map(optimize_path, jobs)
         else:
-            rect_list = rectangles[rgba_tuple]
-            if arguments.reverse:
-                rect_list.reverse()
-            for rect in rect_list:
-                layer.add(rect)
-
-    print("write: {0}".format(svgdoc.filename))
-    svgdoc.save(pretty=True)
-
-    f = open(svg_filename, 'a')
-    f.writelines([
-        "<!-- created by pixel2svg.py -->\n",
-        "<!-- https://github.com/doj/pixel2svg-fork -->\n",
-        ])
-    f.close()
+            permutations = [optimize_path(job) for job in jobs]
+        for (k, permutation) in zip(optimized, permutations):
+            layer_rects[k] = rectangles[k][permutation]
+    if arguments.reverse:
+        layer_rects = [r[::-1] for r in layer_rects]
+
+    # output rectangles on a separate, locked inkscape layer for each color.
+    # the layers are independent of each other, collect the arguments for serialize_layer().
+    layers = []
+    names = color_names(palette)
+    for (k, rgba) in enumerate(palette.tolist()):
+        rgba_tuple = unpack_color(rgba)
+        name = names[k]
+        print("  "+name+" for "+str(rgba_tuple)+" with "+str(len(rectangles[k]))+" rectangles")
+        layers.append((name, layer_rects[k], {rgba: fill_str[rgba]}, posn_str, size_str, arguments.pretty))
+
+    # formatting large layers is worth the overhead of additional processes.
+    # otherwise each layer is formatted when it is written, so only one layer is held in memory.
+    if len(layers) > 1 and len(rects) >= PARALLEL_RECTANGLES and multiprocessing.cpu_count() > 1:
+        with multiprocessing.Pool() as pool:
+            layer_svg = pool.starmap(serialize_layer, layers)
+    else:
+        layer_svg = (serialize_layer(*layer) for layer in layers)
+
+    # write the SVG text directly to the file
+    print("write: {0}".format(svg_filename))
+    (indent, newline) = ('  ', '\n') if arguments.pretty else ('', '')
+    with open(svg_filename, 'w') as svg:
+        svg.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+        svg.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" '
+                  'xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" '
+                  'xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" '
+                  'xmlns:xlink="http://www.w3.org/1999/xlink" baseProfile="full" '
+                  'height="{0}{2}" version="1.1" viewBox="0 0 {1} {0}" width="{1}{2}">'.format(
+                      image_height * squaresize, image_width * squaresize, unit) + newline)
+        svg.write(indent + '<defs/>' + newline)
+        for text in layer_svg:
+            svg.write(text)
+        svg.write('</svg>\n')
+        svg.write("<!-- created by pixel2svg.py -->\n")
+        svg.write("<!-- https://github.com/doj/pixel2svg-fork -->\n")
     sys.exit(0)
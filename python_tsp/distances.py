@@ -37,9 +37,15 @@ def euclidean_distance_matrix(
     call this this function with ``destinations`` set to `None`.
     """
     sources, destinations = _process_input(sources, destinations)
-    return np.sqrt(
-        ((sources[:, :, None] - destinations[:, :, None].T) ** 2).sum(axis=1)
+    # sum over one coordinate at a time, which avoids an (N x n x M)
+    # intermediate array and keeps the data type of the input
+    squared = np.zeros(
+        (sources.shape[0], destinations.shape[0]),
+        dtype=np.result_type(sources, destinations, np.float32),
     )
+    for k in range(sources.shape[1]):
+        squared += (sources[:, [k]] - destinations[:, k]) ** 2
+    return np.sqrt(squared)
 
 
 def great_circle_distance_matrix(
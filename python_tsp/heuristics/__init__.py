@@ -5,3 +5,4 @@
 
 from .local_search import solve_tsp_local_search  # noqa
 from .simulated_annealing import solve_tsp_simulated_annealing  # noqa
+from .two_opt import solve_tsp_two_opt  # noqa
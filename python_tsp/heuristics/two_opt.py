@@ -0,0 +1,109 @@
+"""Vectorized 2-opt local search solver"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from python_tsp.utils import compute_permutation_distance
+
+
+def solve_tsp_two_opt(
+    distance_matrix: np.ndarray,
+    x0: Optional[List[int]] = None,
+    max_passes: Optional[int] = None,
+) -> Tuple[List, float]:
+    """Solve a TSP problem with a 2-opt local search
+
+    Parameters
+    ----------
+    distance_matrix
+        Distance matrix of shape (n x n) with the (i, j) entry indicating the
+        distance from node i to j
+
+    x0
+        Initial permutation. If not provided, it starts with the nearest
+        neighbor path from node 0
+
+    max_passes {None}
+        Maximum number of passes over all nodes. If not provided, the method
+        stops only when a local minimum is obtained
+
+    Returns
+    -------
+    A permutation of nodes from 0 to n - 1 that produces the least total
+    distance obtained (not necessarily optimal).
+
+    The total distance the returned permutation produces.
+
+    Notes
+    -----
+    Reversing the subsequence x[i..j] of the permutation replaces the edges
+    (x[i - 1], x[i]) and (x[j], x[j + 1]) with (x[i - 1], x[j]) and
+    (x[i], x[j + 1]). For a fixed i the change in distance of all moves is
+    computed with one array operation, and the best improving move is
+    applied. Node 0 always stays the first node.
+
+    Edges inside the reversed subsequence change their direction, so the
+    distance matrix is expected to be symmetric, except for the column of
+    node 0: the distance back to the first node may be set to 0 to search
+    for an open path.
+
+    A move is only applied if it improves the distance by more than the
+    rounding error of the data type of the distance matrix, so a float32
+    matrix does not cycle between moves whose deltas are rounding noise.
+    """
+    n = distance_matrix.shape[0]
+    x = np.array(x0 if x0 else nearest_neighbor_permutation(distance_matrix))
+    max_passes = max_passes or np.inf
+    tolerance = 0.0
+    if n > 0 and np.issubdtype(distance_matrix.dtype, np.floating):
+        tolerance = (
+            8 * np.finfo(distance_matrix.dtype).eps * distance_matrix.max()
+        )
+
+    passes = 0
+    improvement = True
+    while improvement and passes < max_passes:
+        improvement = False
+        passes += 1
+        for i in range(1, n - 1):
+            a = x[i - 1]
+            b = x[i]
+            c = x[i + 1:]
+            d = np.append(x[i + 2:], x[0])
+            delta = (
+                distance_matrix[a, c] + distance_matrix[b, d]
+                - distance_matrix[a, b] - distance_matrix[c, d]
+            )
+            k = int(np.argmin(delta))
+            if delta[k] < -tolerance:
+                j = i + 1 + k
+                x[i:j + 1] = x[i:j + 1][::-1]
+                improvement = True
+
+    x = x.tolist()
+    return x, compute_permutation_distance(distance_matrix, x)
+
+
+def nearest_neighbor_permutation(distance_matrix: np.ndarray) -> List[int]:
+    """Greedy path which always visits the nearest unvisited node next
+
+    Parameters
+    ----------
+    distance_matrix
+        Distance matrix of shape (n x n) with the (i, j) entry indicating the
+        distance from node i to j
+
+    Returns
+    -------
+    A permutation of nodes from 0 to n - 1 starting with node 0
+    """
+    n = distance_matrix.shape[0]
+    visited = np.zeros(n, dtype=bool)
+    permutation = [0]
+    visited[0] = True
+    for _ in range(n - 1):
+        distances = np.where(visited, np.inf, distance_matrix[permutation[-1]])
+        node = int(np.argmin(distances))
+        permutation.append(node)
+        visited[node] = True
+    return permutation
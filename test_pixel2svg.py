@@ -0,0 +1,150 @@
+"""Regression checks for the rectangle scanners of pixel2svg"""
+
+import numpy as np
+from PIL import Image
+
+from pixel2svg import find_rectangles, quantize_image
+
+
+# the combine loop of pixel2svg 0.6.0 for identical pixels, one pixel at a time.
+# combined pixels below the current row get alpha 0, so they are skipped later on.
+def reference_rectangles(packed):
+    (height, width) = packed.shape
+    pixels = packed.tolist()
+    rects = []
+    for Y in range(height):
+        X = 0
+        while X < width:
+            rgba = pixels[Y][X]
+            w = 1
+            if rgba >> 24:
+                while X+w < width and pixels[Y][X+w] == rgba:
+                    w += 1
+                h = 1
+                while Y+h < height and pixels[Y+h][X:X+w] == [rgba] * w:
+                    pixels[Y+h][X:X+w] = [p & 0xFFFFFF for p in pixels[Y+h][X:X+w]]
+                    h += 1
+                rects.append((X, Y, w, h, rgba))
+            X += w
+    return rects
+
+# similar_color() of pixel2svg 0.6.0 for packed colors: identical colors, or colors with a sum of
+# squared RGB differences smaller than @p sensitivity. the alpha values are not compared.
+def reference_similar_color(a, b, sensitivity):
+    if a == b:
+        return True
+    return sum((((a >> shift) & 0xFF) - ((b >> shift) & 0xFF)) ** 2 for shift in (0, 8, 16)) < sensitivity
+
+# the combine loop of pixel2svg 0.6.0 for similar pixels, one pixel at a time.
+# the rectangles grow over pixels with a similar RGB value even if they are transparent
+# or combined already, only the top left pixel of a rectangle needs to be visible.
+def reference_similar_rectangles(packed, sensitivity):
+    (height, width) = packed.shape
+    pixels = packed.tolist()
+    rects = []
+    for Y in range(height):
+        X = 0
+        while X < width:
+            rgba = pixels[Y][X]
+            w = 1
+            if rgba >> 24:
+                while X+w < width and reference_similar_color(pixels[Y][X+w], rgba, sensitivity):
+                    w += 1
+                h = 1
+                while Y+h < height and all(reference_similar_color(p, rgba, sensitivity) for p in pixels[Y+h][X:X+w]):
+                    pixels[Y+h][X:X+w] = [p & 0xFFFFFF for p in pixels[Y+h][X:X+w]]
+                    h += 1
+                rects.append((X, Y, w, h, rgba))
+            X += w
+    return rects
+
+# check that @p rects cover each visible pixel of @p packed exactly once with its color
+def check_coverage(packed, rects):
+    coverage = np.zeros(packed.shape, dtype=int)
+    for (X, Y, w, h, rgba) in rects.tolist():
+        assert (packed[Y:Y+h, X:X+w] == rgba).all()
+        coverage[Y:Y+h, X:X+w] += 1
+    assert (coverage == ((packed >> 24) != 0)).all()
+
+def disk_image(size):
+    (Y, X) = np.mgrid[0:size, 0:size] - (size - 1) / 2
+    inside = X * X + Y * Y <= (size / 2) ** 2
+    return np.where(inside, 0xFF0000FF, 0).astype('<u4')
+
+# random blobs of 4 opaque colors on a transparent background
+def blob_image(size, seed):
+    rng = np.random.default_rng(seed)
+    packed = np.zeros((size, size), dtype='<u4')
+    (Y, X) = np.mgrid[0:size, 0:size]
+    for _ in range(size // 4):
+        (cy, cx) = rng.integers(0, size, 2)
+        r = rng.integers(2, max(3, size // 6))
+        color = 0xFF000000 | int(rng.choice([0x0000FF, 0x00FF00, 0xFF0000, 0x808080]))
+        packed[(X - cx) ** 2 + (Y - cy) ** 2 <= r * r] = color
+    return packed
+
+# blobs of 3 base colors with small random RGB changes, on an opaque background with
+# transparent and half transparent holes which keep a random RGB value
+def near_color_image(size, seed):
+    rng = np.random.default_rng(seed)
+    base = np.array([0xFF204060, 0xFF2A4A5A, 0xFFC08020])
+    index = np.zeros((size, size), dtype=int)
+    (Y, X) = np.mgrid[0:size, 0:size]
+    for _ in range(size // 3):
+        (cy, cx) = rng.integers(0, size, 2)
+        r = rng.integers(2, max(3, size // 4))
+        index[(X - cx) ** 2 + (Y - cy) ** 2 <= r * r] = rng.integers(0, len(base))
+    noise = rng.integers(0, 4, (size, size, 3)) * rng.integers(0, 2, (size, size, 1))
+    packed = base[index] + (noise * [1, 0x100, 0x10000]).sum(axis=2)
+    holes = rng.random((size, size))
+    packed = np.where(holes < 0.1, packed & 0xFFFFFF, packed)
+    packed = np.where((holes >= 0.1) & (holes < 0.15), (packed & 0xFFFFFF) | 0x80000000, packed)
+    return packed.astype('<u4')
+
+def test_combine_similar():
+    for seed in range(10):
+        packed = near_color_image(40, seed)
+        for sensitivity in (1, 20, 200, 3000):
+            rects = find_rectangles(packed, True, sensitivity)
+            assert rects.tolist() == [list(r) for r in reference_similar_rectangles(packed, sensitivity)]
+
+def test_combine_disk():
+    packed = disk_image(400)
+    rects = find_rectangles(packed, True, 0)
+    check_coverage(packed, rects)
+    assert rects.tolist() == [list(r) for r in reference_rectangles(packed)]
+
+def test_combine_blobs():
+    for seed in range(20):
+        packed = blob_image(48, seed)
+        rects = find_rectangles(packed, True, 0)
+        check_coverage(packed, rects)
+        assert rects.tolist() == [list(r) for r in reference_rectangles(packed)]
+
+# a sprite of @p colors random opaque colors on a transparent black background
+def sprite_image(colors, seed):
+    rng = np.random.default_rng(seed)
+    rgba = np.zeros((100, 100, 4), dtype=np.uint8)
+    palette = rng.choice(1 << 24, colors, replace=False)
+    for (k, color) in enumerate(palette.tolist()):
+        (y, x) = (k // 4 * 25, k % 4 * 25)
+        rgba[y+2:y+23, x+2:x+23] = [color & 0xFF, (color >> 8) & 0xFF, color >> 16, 255]
+    return rgba
+
+def test_quantize_sprite():
+    for colors in (2, 3, 8, 16):
+        for seed in range(5):
+            rgba = sprite_image(colors, seed)
+            assert (np.asarray(quantize_image(Image.fromarray(rgba), colors)) == rgba).all()
+
+def test_pixels():
+    packed = blob_image(32, 0)
+    rects = find_rectangles(packed, False, 0)
+    check_coverage(packed, rects)
+    assert len(rects) == np.count_nonzero(packed >> 24)
+
+if __name__ == "__main__":
+    for (name, test) in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("{0}: ok".format(name))